@@ -35,19 +35,41 @@
 
 __version__ = '0.9.1'
 
+import os
 import pdb
 import sys
+import math
+import zlib
+import json
 import signal
+import socket
 import logging
 import threading
+import multiprocessing
 import MySQLdb as mdb
 import RPi.GPIO as GPIO
 from datetime import datetime
-from time import mktime, sleep
+from time import time, mktime, sleep
 from optparse import OptionParser
+from collections import deque
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from httplib import HTTPException
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from http.client import HTTPException
 
 from w1thermsensor import W1ThermSensor
 
+try:
+    from time import monotonic
+except ImportError:
+    def monotonic():
+        """Elapsed seconds since boot, not affected by clock steps."""
+        return os.times()[4]
+
 # GPIO port of the relay board
 HEATER_GPIO = 21
 
@@ -57,6 +79,23 @@ DB_USER = 'fermpi'
 DB_PWD = 'frosttau97'
 DB_NAME = 'fermpi'
 
+# sampler parameters
+SAMPLER_SLOTS = 64               # size of the ring buffer
+SAMPLER_INTERVAL = 5             # seconds between two samples
+SAMPLER_TIMEOUT = 60             # seconds until the readings are stale
+
+# signal conditioning parameters
+FILTER_ALPHA = 0.3               # smoothing factor of the exponential filter
+FILTER_MAX_STEP = 2.0            # max. change between two samples in °C
+FILTER_MAX_REJECTS = 3           # consecutive rejects before re-syncing/invalidating
+FILTER_WINDOW = 24               # number of samples for the slope
+FILTER_DEADBAND = 0.05           # min. slope of a trend in °C/min
+
+# upload parameters, see fermpi_ingest.py
+UPLOAD_BATCH = 200               # max. number of entries per batch
+UPLOAD_INTERVAL = 30             # seconds between two uploads
+UPLOAD_LIMIT = 20000             # max. number of buffered entries
+
 # controller states
 FPI_STATE_OFF = int(0)
 FPI_STATE_ON = int(1)
@@ -68,6 +107,443 @@ FPI_MODE_GRADUAL = int(2)
 
 # global variables
 thread = None
+sampler = None
+uploader = None
+
+
+def _sample(ids, ring, index, interval, stop):
+    """Main function of the sampler process.
+
+       Reads all sensors every interval seconds and writes the
+       monotonic timestamp and the temperatures into the next slot of the
+       ring buffer. The index is incremented after the slot has
+       been written, so the readers never see a partial sample.
+       A failed reading is stored as NaN.
+    """
+    # the parent process handles the signals and cleans up
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    parent = os.getppid()
+    width = len(ids) + 1
+    sensors = [W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, id) for id in ids]
+
+    while not stop.is_set() and os.getppid() == parent:
+        sample = [monotonic()]
+        for sensor in sensors:
+            try:
+                sample.append(sensor.get_temperature())
+            except Exception:
+                sample.append(float('nan'))
+
+        if stop.is_set():
+            # replaced by a new process meanwhile
+            break
+
+        n = index.value
+        base = (n % SAMPLER_SLOTS) * width
+        ring[base:base+width] = sample
+        index.value = n + 1
+
+        stop.wait(max(0.0, interval - (monotonic() - sample[0])))
+
+
+class Sampler(object):
+    """Reads the 1-Wire sensors in a separate process.
+
+       A stuck or crashing sensor driver can't block the relay
+       switching this way. The samples are shared through a ring
+       buffer in shared memory, which is written by the sampler
+       process only. Reading the latest sample neither blocks nor
+       takes any lock.
+
+       The timestamps are taken from a monotonic clock, the Pi's
+       wall clock may be stepped at any time by NTP.
+
+       The available sensors are enumerated on every (re)start. If
+       they have changed, a new ring buffer is used and the generation
+       is incremented, so the readers know to re-initialize.
+    """
+    def __init__(self, interval=SAMPLER_INTERVAL):
+        """Initialization of class properties
+
+           Args:
+               interval (int): seconds between two samples
+        """
+        self._logger = logging.getLogger(__name__)
+
+        self.ids = []                    # sensor ids
+        self.generation = int(0)         # incremented, when the sensors change
+        self.started = float(0)          # monotonic start time of the process
+
+        self._interval = interval
+        self._width = 0                  # timestamp + temperatures
+        self._ring = None
+        self._index = None               # number of samples
+        self._stop = None
+        self._process = None
+
+    def _enumerate(self):
+        """Gets the ids of the available sensors."""
+        try:
+            return [sensor.id for sensor in W1ThermSensor.get_available_sensors()]
+        except Exception as e:
+            self._logger.error(" Enumerating sensors failed: %s" % (e))
+            return []
+
+    def start(self):
+        """Starts the sampler process for the available sensors."""
+        ids = self._enumerate()
+        if self._ring is None or ids != self.ids:
+            self.ids = ids
+            self.generation += 1
+            self._width = len(ids) + 1
+            self._ring = multiprocessing.RawArray('d', SAMPLER_SLOTS * self._width)
+            self._index = multiprocessing.RawValue('L', 0)
+            self._logger.info(" Sampler sensors: %s" % (", ".join(ids) or "none"))
+
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_sample,
+                                                args=(self.ids, self._ring, self._index,
+                                                      self._interval, self._stop))
+        self._process.daemon = True
+        self._process.start()
+        self.started = monotonic()
+
+        self._logger.info(" Sampler started (pid %d)" % (self._process.pid))
+
+    def stop(self):
+        """Stops the sampler process, kills it if it doesn't respond.
+
+           Never waits without a bound: a process stuck in uninterruptible
+           I/O can't even be killed, it is left behind in this case.
+        """
+        if self._process is None:
+            return
+
+        self._stop.set()
+        self._process.join(self._interval + 2.0)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join(2.0)
+        if self._process.is_alive():
+            try:
+                os.kill(self._process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._process.join(2.0)
+        if self._process.is_alive():
+            self._logger.error(" Sampler (pid %d) doesn't respond, abandoned" % (self._process.pid))
+        self._process = None
+
+    def restart(self):
+        """Replaces a dead or stuck sampler process."""
+        self.stop()
+        self.start()
+
+    def refresh(self):
+        """Restarts the sampler, if the available sensors have changed."""
+        if self._enumerate() != self.ids:
+            self.restart()
+
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def latest(self):
+        """Gets the latest sample.
+
+           Return:
+               (timestamp, temperatures) or None, if there is no sample yet
+        """
+        while True:
+            n = self._index.value
+            if n == 0:
+                return None
+
+            base = ((n - 1) % SAMPLER_SLOTS) * self._width
+            sample = self._ring[base:base+self._width]
+
+            # the slot is valid, unless the sampler has wrapped around meanwhile
+            if self._index.value - n < SAMPLER_SLOTS - 1:
+                return (sample[0], sample[1:])
+
+    def samples(self, since):
+        """Gets the samples taken after the given one.
+
+           At most half of the ring buffer is returned, older samples
+           are skipped.
+
+           Args:
+               since (int): index returned by the previous call, 0 at first
+
+           Return:
+               (index, samples), samples is a list of (timestamp, temperatures)
+        """
+        while True:
+            n = self._index.value
+            first = max(since, n - SAMPLER_SLOTS // 2)
+
+            samples = []
+            for i in range(first, n):
+                base = (i % SAMPLER_SLOTS) * self._width
+                sample = self._ring[base:base+self._width]
+                samples.append((sample[0], sample[1:]))
+
+            if self._index.value - first < SAMPLER_SLOTS:
+                return (n, samples)
+
+
+class SignalConditioner(object):
+    """Conditions the readings of a single sensor.
+
+       The DS18B20 delivers 0.0625°C steps and occasionally bad
+       readings, e.g. its power-on value of 85°C. Comparing two raw
+       readings therefore doesn't give a reliable trend.
+
+       Failed, out-of-range and implausible readings are rejected. If
+       the temperature really jumps, the filter is re-synced after
+       FILTER_MAX_REJECTS consecutive rejects. After more consecutive
+       failed readings, or without an accepted reading for
+       SAMPLER_TIMEOUT seconds, the filter is invalidated (value is
+       None), so no decision is based on outdated values. The power-on
+       value of 85°C is never used to (re-)start the filter, a real
+       temperature of 85°C is confirmed by its neighbouring readings.
+       The remaining readings
+       are smoothed by a median of three and an exponential filter.
+       The slope is the linear regression of the last FILTER_WINDOW
+       filtered values, kept up to date by running sums. Each sample
+       takes constant time.
+    """
+    def __init__(self):
+        self.raw = None                  # latest raw reading
+        self.value = None                # filtered temperature
+        self.slope = float(0)            # °C per minute
+
+        self._rejects = int(0)           # consecutive rejects
+        self._accepted = float(0)        # time of the last accepted reading
+        self._median = deque(maxlen=3)   # latest accepted readings
+        self._window = deque()           # (time, value) for the slope
+        self._origin = float(0)          # time offset of the window
+        self._sums = [0.0, 0.0, 0.0, 0.0]    # t, v, t*t, t*v
+
+    def _reset(self):
+        self.value = None
+        self.slope = float(0)
+        self._median.clear()
+        self._window.clear()
+        self._sums = [0.0, 0.0, 0.0, 0.0]
+
+    def _rebase(self, ts):
+        """Moves the time offset of the window to the given timestamp.
+
+           Keeps the running sums small, so they don't lose precision.
+        """
+        shift = self._origin - ts
+        self._origin = ts
+        self._window = deque([(t + shift, v) for (t, v) in self._window])
+        self._sums = [0.0, 0.0, 0.0, 0.0]
+        for (t, v) in self._window:
+            self._add(t, v, 1)
+
+    def _reject(self):
+        self._rejects += 1
+        if self._rejects > FILTER_MAX_REJECTS:
+            self._reset()
+        return False
+
+    def _add(self, t, v, sign):
+        self._sums[0] += sign * t
+        self._sums[1] += sign * v
+        self._sums[2] += sign * t * t
+        self._sums[3] += sign * t * v
+
+    def update(self, ts, raw):
+        """Processes a new reading.
+
+           Args:
+               ts (float): timestamp of the reading
+               raw (float): temperature in °C, NaN if the reading failed
+
+           Return:
+               True  = reading accepted
+               False = reading rejected
+        """
+        self.raw = raw
+
+        if self.value is not None and ts - self._accepted > SAMPLER_TIMEOUT:
+            # no accepted reading for too long
+            self._reset()
+
+        if raw != raw or raw < -55.0 or raw > 125.0:
+            # failed or out of the sensor's range
+            return self._reject()
+
+        if self.value is not None and abs(raw - self.value) > FILTER_MAX_STEP:
+            if self._rejects < FILTER_MAX_REJECTS:
+                return self._reject()
+            # the temperature really has changed
+            self._reset()
+
+        if self.value is None and raw == 85.0:
+            # power-on value
+            return self._reject()
+
+        self._rejects = 0
+        self._accepted = ts
+
+        # median of three and exponential filter
+        self._median.append(raw)
+        median = sorted(self._median)[len(self._median) // 2]
+        if self.value is None:
+            self.value = median
+        else:
+            self.value += FILTER_ALPHA * (median - self.value)
+
+        # slope of the window
+        if len(self._window) == 0 or ts - self._origin > 3600.0:
+            self._rebase(ts)
+        self._window.append((ts - self._origin, self.value))
+        self._add(ts - self._origin, self.value, 1)
+        if len(self._window) > FILTER_WINDOW:
+            t, v = self._window.popleft()
+            self._add(t, v, -1)
+
+        n = len(self._window)
+        d = n * self._sums[2] - self._sums[0] * self._sums[0]
+        if n > 1 and d > 0:
+            self.slope = 60.0 * (n * self._sums[3] - self._sums[0] * self._sums[1]) / d
+
+        return True
+
+
+class Uploader(threading.Thread):
+    """Uploads the readings and events to the ingestion service.
+
+       Instead of writing every row into the database, the entries
+       are buffered and pushed to fermpi_ingest.py in compressed
+       batches. Every batch carries a sequence number, so the service
+       can drop batches which are resent after a lost response.
+
+       A batch is kept until the service has acknowledged it. While
+       the service is busy or unreachable, new entries are buffered
+       up to UPLOAD_LIMIT entries, after that the oldest are dropped.
+    """
+    def __init__(self, url, controller):
+        """Initialization of class properties
+
+           Args:
+               url (str): url of the ingestion service
+               controller (str): name of this controller
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self._logger = logging.getLogger(__name__)
+
+        self.event = threading.Event()
+
+        self._url = url
+        self._controller = controller
+        self._session = int(round(mktime(datetime.utcnow().timetuple())))
+        self._seq = int(0)               # sequence number of the last batch
+
+        self._lock = threading.Lock()
+        self._entries = deque()          # buffered entries
+        self._batch = None               # unacknowledged batch
+        self._dropped = int(0)           # number of dropped entries
+
+    def put(self, entry):
+        """Buffers an entry for the next upload.
+
+           Args:
+               entry (list): log, event or purge entry
+        """
+        with self._lock:
+            if len(self._entries) >= UPLOAD_LIMIT:
+                self._entries.popleft()
+                self._dropped += 1
+            self._entries.append(entry)
+
+    def _upload(self):
+        """Sends the pending batch, if any.
+
+           Return:
+               0    = batch acknowledged or nothing to send
+               secs = service not available, retry after secs
+        """
+        if self._batch is None:
+            with self._lock:
+                if len(self._entries) == 0:
+                    return 0
+                n = min(UPLOAD_BATCH, len(self._entries))
+                entries = [self._entries.popleft() for i in range(n)]
+
+                if self._dropped > 0:
+                    self._logger.warning(" Upload buffer full, %d entries dropped" % (self._dropped))
+                    self._dropped = 0
+
+            self._seq += 1
+            self._batch = zlib.compress(json.dumps({'controller': self._controller,
+                                                    'session': self._session,
+                                                    'seq': self._seq,
+                                                    'entries': entries}).encode('utf-8'))
+
+        request = Request(self._url, self._batch,
+                          {'Content-Type': 'application/json',
+                           'Content-Encoding': 'deflate'})
+        try:
+            urlopen(request, timeout=10).read()
+        except HTTPError as e:
+            if e.code == 503:
+                try:
+                    retry = int(e.headers.get('Retry-After', UPLOAD_INTERVAL))
+                except ValueError:
+                    # HTTP-date instead of seconds
+                    retry = UPLOAD_INTERVAL
+                self._logger.info(" Ingestion service busy, retrying in %ds" % (retry))
+                return retry
+            # the service will never accept this batch
+            self._logger.error(" Upload rejected (%d), batch %d dropped" % (e.code, self._seq))
+            self._batch = None
+            return UPLOAD_INTERVAL
+        except (URLError, HTTPException, socket.error) as e:
+            self._logger.error(" Upload failed: %s" % (e))
+            return UPLOAD_INTERVAL
+
+        self._batch = None
+        return 0
+
+    def _try_upload(self):
+        """Calls _upload(), the thread must not die on unexpected errors."""
+        try:
+            return self._upload()
+        except Exception as e:
+            self._logger.error(" Upload failed: %r" % (e))
+            return UPLOAD_INTERVAL
+
+    def run(self):
+        """Uploads the buffered entries.
+
+           Full batches are sent immediately, the rest every
+           UPLOAD_INTERVAL seconds. The thread is stopped by calling
+           it's event.set() function, remaining entries are sent
+           before leaving.
+        """
+        delay = 0
+        while not self.event.wait(delay):
+            delay = self._try_upload()
+            if delay == 0 and len(self._entries) < UPLOAD_BATCH:
+                delay = UPLOAD_INTERVAL
+
+        # final upload, give up after UPLOAD_INTERVAL seconds
+        deadline = time() + UPLOAD_INTERVAL
+        while self._batch is not None or len(self._entries) > 0:
+            delay = self._try_upload()
+            if delay > 0:
+                if time() + delay > deadline:
+                    self._logger.error(" Final upload failed, remaining entries lost")
+                    break
+                sleep(delay)
 
 
 class FermentationThread(threading.Thread):
@@ -112,27 +588,47 @@ class FermentationThread(threading.Thread):
         self._overshoot = float(0)       # heater overshoot
 
         self._sensors = []               # temperature sensors
+        self._filters = []               # signal conditioners of the sensors
+        self._index = int(0)             # index of the next sample
+        self._good = []                  # monotonic time of the last good reading per sensor
+        self._generation = int(0)        # sampler generation of the sensors
         self._state = int(0)             # controller state
 
         self._timestamp = int(0)         # set, when the target temperature is reached
 
+        # pick up sensors, which have appeared since the last mode
+        sampler.refresh()
+        self._init_sensors()
+
+    def _init_sensors(self):
+        """Initializes the temperature sensors of the sampler.
+
+           The sensors are registered in the database, if necessary.
+        """
         self._logger.info(" ----------------------------------------")
         self._logger.info(" Initializing sensors...")
 
-        # initializing the temperature sensors
+        self._sensors = []
+        self._filters = []
+        self._good = []
+        self._index = int(0)
+        self._generation = sampler.generation
+
         conn = mdb.connect(DB_HOST, DB_USER, DB_PWD, DB_NAME)
         with conn as cur:
             i = 0
-            for sensor in W1ThermSensor.get_available_sensors():
-                if sensor.id not in self._sensors:
-                    cur.execute("SELECT * FROM sensors WHERE sensor = '%s'" %(sensor.id))
+            for sensor in sampler.ids:
+                if sensor not in self._sensors:
+                    cur.execute("SELECT * FROM sensors WHERE sensor = '%s'" %(sensor))
                     sid = cur.fetchone()[0]
                     if sid is None:
-                        cur.execute("INSERT INTO sensors VALUES (0, '%s')" % (sensor.id))
-                        cur.execute("SELECT * FROM sensors WHERE sensor = '%s'" %(sensor.id))
+                        cur.execute("INSERT INTO sensors VALUES (0, '%s')" % (sensor))
+                        cur.execute("SELECT * FROM sensors WHERE sensor = '%s'" %(sensor))
                         sid = cur.fetchone()[0]
 
-                self._sensors.append([sensor.id, sid, 0.0, 0.0])
+                self._sensors.append([sensor, sid, 0.0, 0.0, 0.0, 0.0])
+                self._filters.append(SignalConditioner())
+                self._good.append(monotonic())
                 self._logger.info(" Sensor %d:    %s" % (i+1, self._sensors[i][0]))
                 i += 1
         conn.close()
@@ -140,41 +636,166 @@ class FermentationThread(threading.Thread):
     def _read_temperatures(self):
         """Reading the temperature values of the available sensors.
 
-           The W1ThermSensor-Interface is used to read the temperature
-           values of the available sensors. The previous values are
-           stored.
+           The new samples of the sampler process are passed through the
+           signal conditioners. The filtered and the previous filtered
+           values, the latest raw reading and the slope are stored. A
+           sampler process, which has died or hasn't delivered a sample
+           for SAMPLER_TIMEOUT seconds, is restarted. The readings are not
+           current either, if the control sensor (sensor 1) hasn't delivered
+           a good reading for SAMPLER_TIMEOUT seconds.
+
+           Return:
+               True  = current values available
+               False = no current values
         """
         self._logger.info(" ----------------------------------------")
         self._logger.info(" Reading sensor values...")
 
-        for i in range(0, len(self._sensors), 4):
-            sensor = W1ThermSensor(W1ThermSensor.THERM_SENSOR_DS18B20, self._sensors[i][0])
+        sample = sampler.latest()
+        if sample is None:
+            age = monotonic() - sampler.started
+        else:
+            # a restarted sampler gets SAMPLER_TIMEOUT seconds for its first sample
+            age = monotonic() - max(sample[0], sampler.started)
+
+        if not sampler.is_alive() or age > SAMPLER_TIMEOUT:
+            self._logger.error(" Sampler stalled for %ds, restarting..." % (age))
+            # don't leave the heater on, while waiting for the sampler
+            self._safe_state()
+            self._log_event('sampler restarted')
+            sampler.restart()
+            return False
+
+        if self._generation != sampler.generation:
+            # the sensors have changed with a restart of the sampler
+            self._init_sensors()
+
+        if len(self._sensors) == 0:
+            self._logger.warning(" No sensors available")
+            sampler.refresh()
+            return False
+
+        if sample is None:
+            self._logger.info(" Waiting for first sample...")
+            return False
+
+        self._index, samples = sampler.samples(self._index)
+        for sample in samples:
+            for i in range(0, len(self._sensors)):
+                if sample[1][i] == sample[1][i]:
+                    self._good[i] = sample[0]
+                if self._filters[i].update(sample[0], sample[1][i]) is False:
+                    self._logger.warning(" Sensor %s:   reading %s°C rejected" %
+                                         (self._sensors[i][1], sample[1][i]))
+
+        if monotonic() - self._good[0] > SAMPLER_TIMEOUT:
+            self._logger.error(" Sensor %s:   no good reading for %ds" %
+                               (self._sensors[0][1], monotonic() - self._good[0]))
+            return False
+
+        # only the control sensor is required
+        if self._filters[0].value is None:
+            self._logger.error(" Sensor %s:   no valid reading" % (self._sensors[0][1]))
+            return False
+
+        for i in range(0, len(self._sensors)):
+            self._sensors[i][4] = self._filters[i].raw
+            if self._filters[i].value is None:
+                self._logger.warning(" Sensor %s:   no valid reading" % (self._sensors[i][1]))
+                continue
+
             self._sensors[i][3] = self._sensors[i][2]
-            self._sensors[i][2] = sensor.get_temperature()
+            self._sensors[i][2] = self._filters[i].value
+            self._sensors[i][5] = self._filters[i].slope
 
-            self._logger.info(" Sensor %s:   %s°C   %s°C" %
+        for i in range(0, len(self._sensors), 4):
+            self._logger.info(" Sensor %s:   %s°C   %s°C   raw %s°C   %s°C/min" %
                               (self._sensors[i][1],
                                "{:>6.2f}".format(self._sensors[i][2]),
-                               "{:>6.2f}".format(self._sensors[i][3])))
+                               "{:>6.2f}".format(self._sensors[i][3]),
+                               "{:>6.2f}".format(self._sensors[i][4]),
+                               "{:>+6.2f}".format(self._sensors[i][5])))
 
         if self._target > 0:
             self._logger.info(" ----------------------------------------")
             self._logger.info(" Target:     %s°C" % ("{:>6.2f}".format(self._target)))
             self._logger.info(" Overshoot:  %s°C" % ("{:>6.2f}".format(self._overshoot)))
 
+        return True
+
+    def _rising(self, i):
+        """Checks, if the temperature of the given sensor is increasing."""
+        return self._sensors[i][5] > FILTER_DEADBAND
+
+    def _falling(self, i):
+        """Checks, if the temperature of the given sensor is decreasing."""
+        return self._sensors[i][5] < -FILTER_DEADBAND
+
+    def _safe_state(self):
+        """Switches the heater off, if it is on."""
+        if self._heater == self.HEATER_ON:
+            self._heater_off()
+            self._state = self.IDLE
+
+    def _wait_for_readings(self):
+        """Waits one cycle for current readings.
+
+           The heater is switched off in the meantime, it must not be
+           controlled by outdated temperatures.
+        """
+        self._safe_state()
+        self.event.wait(self._cycle)
+
+    def _sensor_logs(self):
+        """Gets the sensor values to be logged.
+
+           Sensors without a valid filtered value are skipped, their
+           last value is outdated. A failed raw reading is logged as None.
+
+           Return:
+               list of (sensor, temperature, raw)
+        """
+        logs = []
+        for i in range(0, len(self._sensors), 4):
+            if self._filters[i].value is None:
+                continue
+
+            raw = self._sensors[i][4]
+            if raw is not None and (math.isnan(raw) or math.isinf(raw)):
+                raw = None
+            elif raw is not None:
+                raw = round(raw, 2)
+
+            logs.append((self._sensors[i][1], round(self._sensors[i][2], 2), raw))
+        return logs
+
     def _log_data(self, ts):
         """Logs the temperature values and the heater status.
 
            Args:
                ts (int) = timestamp
         """
+        if uploader is not None:
+            # sensor temperatures
+            for (sensor, temperature, raw) in self._sensor_logs():
+                uploader.put(['log', self._id, sensor, temperature, ts, raw])
+            if self._id > 0:
+                # target temperatures and heater state
+                uploader.put(['log', self._id, 0, self._target, ts])
+                uploader.put(['log', self._id, 99, self._heater, ts])
+            return
+
         conn = mdb.connect(DB_HOST, DB_USER, DB_PWD, DB_NAME)
         with conn as cur:
             # sensor temperatures
-            for i in range(0, len(self._sensors), 4):
-                cur.execute("""INSERT INTO logs (fermentation, sensor, temperature, timestamp)
-                               VALUES (%s, %s, %1.2f, %d)""" %
-                               (self._id, self._sensors[i][1], self._sensors[i][2], ts))
+            for (sensor, temperature, raw) in self._sensor_logs():
+                if raw is not None:
+                    raw = "%1.2f" % (raw)
+                else:
+                    raw = "NULL"
+                cur.execute("""INSERT INTO logs (fermentation, sensor, temperature, raw, timestamp)
+                               VALUES (%s, %s, %1.2f, %s, %d)""" %
+                               (self._id, sensor, temperature, raw, ts))
             if self._id > 0:
                 # target temperatures
                 cur.execute("""INSERT INTO logs (fermentation, sensor, temperature, timestamp)
@@ -188,6 +809,25 @@ class FermentationThread(threading.Thread):
 
         conn.close
 
+    def _log_event(self, event):
+        """Logs a controller event.
+
+           Events are recorded in upload mode only. They are buffered,
+           so switching the relay never waits for or fails on the
+           database.
+
+           Args:
+               event (str) = description of the event
+        """
+        if uploader is None:
+            return
+
+        dt = datetime.utcnow()
+        secs = mktime(dt.timetuple())
+        ts = int(round(secs))
+
+        uploader.put(['event', self._id, ts, event])
+
     def _heater_on(self):
         """Switches the heater relay on.
 
@@ -195,6 +835,7 @@ class FermentationThread(threading.Thread):
         """
         GPIO.output(self._gpio, GPIO.LOW)
         self._heater = self.HEATER_ON
+        self._log_event('heater on')
 
     def _heater_off(self):
         """Switches the heater relay off.
@@ -203,6 +844,7 @@ class FermentationThread(threading.Thread):
         """
         GPIO.output(self._gpio, GPIO.HIGH)
         self._heater = self.HEATER_OFF
+        self._log_event('heater off')
 
 
 class IdleMode(FermentationThread):
@@ -226,7 +868,9 @@ class IdleMode(FermentationThread):
         # the thread's main loop
         while not self.event.is_set():
             # read current temperatures
-            self._read_temperatures()
+            if self._read_temperatures() is False:
+                self._wait_for_readings()
+                continue
 
             # create timestamp
             dt = datetime.utcnow()
@@ -239,10 +883,13 @@ class IdleMode(FermentationThread):
             # sleep for the specified cycle time, or until event is set
             self.event.wait(self._cycle)
 
-        conn = mdb.connect(DB_HOST, DB_USER, DB_PWD, DB_NAME)
-        with conn as cur:
-            cur.execute("DELETE FROM logs WHERE fermentation = '0'")
-        conn.close()
+        if uploader is not None:
+            uploader.put(['purge', 0])
+        else:
+            conn = mdb.connect(DB_HOST, DB_USER, DB_PWD, DB_NAME)
+            with conn as cur:
+                cur.execute("DELETE FROM logs WHERE fermentation = '0'")
+            conn.close()
 
 
         self._logger.info(" Leaving idle mode...")
@@ -298,6 +945,7 @@ class ConstantMode(FermentationThread):
         """
         self._logger.info(" ----------------------------------------")
         self._logger.info(" Starting constant mode...")
+        self._log_event('starting constant mode')
 
         self._logger.info(" Target:     %s°C" % ("{:>6.2f}".format(self._target)))
         self._logger.info(" Duration:   %s Minute(s)" % ("{:>3d}".format(self._duration)))
@@ -305,7 +953,9 @@ class ConstantMode(FermentationThread):
         # the thread's main loop
         while not self.event.is_set():
             # read current temperatures
-            self._read_temperatures()
+            if self._read_temperatures() is False:
+                self._wait_for_readings()
+                continue
 
             # create timestamp
             dt = datetime.utcnow()
@@ -322,7 +972,7 @@ class ConstantMode(FermentationThread):
                     if self._heater == self.HEATER_OFF:
                         self._heater_on()
                         self._state = self.HEATING
-                elif self._sensors[0][2] > self._sensors[0][3]:
+                elif self._rising(0):
                     if self._heater == self.HEATER_ON:
                     	self._heater_off()
                         self._state = self.WAITING_FOR_PEAK
@@ -358,7 +1008,7 @@ class ConstantMode(FermentationThread):
                         self._heater_off()
                         self._state = self.WAITING_FOR_PEAK
 
-                    if self._sensors[0][2] < self._sensors[0][3]:
+                    if self._falling(0):
                         # temperature is decreasing
                         self._state = self.IDLE
 
@@ -386,6 +1036,7 @@ class ConstantMode(FermentationThread):
             cur.execute("UPDATE config SET value = '0' WHERE item = 'duration'")
         conn.close()
 
+        self._log_event('leaving constant mode')
         self._logger.info(" Leaving constant mode...")
 
 
@@ -483,6 +1134,7 @@ class GradualMode(FermentationThread):
         """
         self._logger.info(" ----------------------------------------")
         self._logger.info(" Starting gradual mode...")
+        self._log_event('starting gradual mode')
 
         self._logger.info(" Target:     %s°C" % ("{:>6.2f}".format(self._target)))
         self._logger.info(" Duration:   %s Minute(s)" % ("{:>3d}".format(self._duration)))
@@ -490,7 +1142,9 @@ class GradualMode(FermentationThread):
         # the thread's main loop
         while not self.event.is_set():
             # read current temperatures
-            self._read_temperatures()
+            if self._read_temperatures() is False:
+                self._wait_for_readings()
+                continue
 
             # create timestamp
             dt = datetime.utcnow()
@@ -507,12 +1161,12 @@ class GradualMode(FermentationThread):
                     if self._heater == self.HEATER_OFF:
                         self._heater_on()
                         self._state = self.HEATING
-                elif self._sensors[0][2] < self._sensors[0][3]:
+                elif self._falling(0):
                     if self._heater == self.HEATER_OFF:
                         self._heater_on()
                         self.event.wait(20)
                         self._state = self.HEATING
-                elif self._sensors[0][2] > self._sensors[0][3]:
+                elif self._rising(0):
                     if self._heater == self.HEATER_ON:
                         self._heater_off()
                         self._state == self.WAITING_FOR_PEAK
@@ -541,13 +1195,13 @@ class GradualMode(FermentationThread):
 
                 if self._sensors[0][2] <= (self._target - 0.10):
                     # temperature is below threshold
-                    if self._sensors[0][2] < self._sensors[0][3]:
+                    if self._falling(0):
                         # temperature is decreasing
                         self._heater_on()
                         self.event.wait(10)
                         self._heater_off()
                         self._state = self.WAITING_FOR_PEAK
-                elif self._sensors[0][2] < self._sensors[0][3]:
+                elif self._falling(0):
                     # temperature is decreasing
                     self.state = self.IDLE
 
@@ -574,6 +1228,7 @@ class GradualMode(FermentationThread):
             cur.execute("UPDATE config SET value = '0' WHERE item = 'duration'")
         conn.close()
 
+        self._log_event('leaving gradual mode')
         self._logger.info(" Leaving gradual mode...")
 
 
@@ -583,7 +1238,7 @@ def heater_off():
 
 def on_exit(sig, frame):
     """Clean up on exit"""
-    global thread
+    global thread, sampler, uploader
 
     logger = logging.getLogger(__name__)
 
@@ -599,8 +1254,24 @@ def on_exit(sig, frame):
             thread.join(0.5)
         thread = None
 
-    # resetting GPIOs
+    # the modes don't switch the heater off, do it before
+    # waiting for the sampler (up to SAMPLER_INTERVAL + 6s)
+    # and the uploader
     heater_off()
+
+    # stop sampler
+    if sampler is not None:
+        logger.info(" Stopping sampler...")
+        sampler.stop()
+
+    # upload remaining entries, if any
+    if uploader is not None:
+        logger.info(" Stopping uploader...")
+        uploader.event.set()
+        uploader.join(UPLOAD_INTERVAL + 15.0)
+        uploader = None
+
+    # resetting GPIOs
     GPIO.cleanup()
 
     # exitting process
@@ -636,7 +1307,7 @@ def read_configuration():
     return config
 
 def main():
-    global thread
+    global thread, sampler, uploader
 
     # register exit handler
     signal.signal(signal.SIGINT, on_exit)
@@ -645,6 +1316,8 @@ def main():
     # check commandline parameters
     parser = OptionParser()
     parser.add_option("-d", "--debug", dest="debug", action="store_true", default="False", help="print debug information to stdout")
+    parser.add_option("-u", "--upload", dest="upload", default=None, help="upload readings and events to the given ingestion service url")
+    parser.add_option("-n", "--name", dest="name", default=socket.gethostname(), help="controller name used for uploads")
     (options, args) = parser.parse_args(sys.argv)
 
     if options.debug is True:
@@ -664,6 +1337,16 @@ def main():
     GPIO.setup(HEATER_GPIO, GPIO.OUT)
     heater_off()
 
+    # init sampler
+    sampler = Sampler()
+    sampler.start()
+
+    # init uploader
+    if options.upload is not None:
+        logger.info(" Uploading to %s as %s" % (options.upload, options.name))
+        uploader = Uploader(options.upload, options.name)
+        uploader.start()
+
     while True:
         try:
             config = read_configuration()
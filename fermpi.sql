@@ -38,6 +38,20 @@ CREATE TABLE `config` (
 
 -- --------------------------------------------------------
 
+--
+-- Tabellenstruktur für Tabelle `events`
+--
+
+-- DROP TABLE IF EXISTS `events`;
+CREATE TABLE `events` (
+  `id` bigint(10) UNSIGNED NOT NULL,
+  `fermentation` int(10) UNSIGNED NOT NULL,
+  `timestamp` varchar(24) NOT NULL,
+  `event` varchar(64) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
 --
 -- Tabellenstruktur für Tabelle `fermentations`
 --
@@ -70,6 +84,7 @@ CREATE TABLE `logs` (
   `fermentation` int(10) UNSIGNED NOT NULL,
   `sensor` tinyint(3) UNSIGNED NOT NULL,
   `temperature` varchar(7) NOT NULL,
+  `raw` varchar(7) DEFAULT NULL,
   `timestamp` varchar(24) NOT NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
@@ -119,6 +134,13 @@ ALTER TABLE `config`
   ADD PRIMARY KEY (`id`),
   ADD UNIQUE KEY `item` (`item`);
 
+--
+-- Indizes für die Tabelle `events`
+--
+ALTER TABLE `events`
+  ADD PRIMARY KEY (`id`),
+  ADD KEY `EVT` (`fermentation`,`timestamp`);
+
 --
 -- Indizes für die Tabelle `fermentations`
 --
@@ -157,6 +179,11 @@ ALTER TABLE `sensors`
 ALTER TABLE `config`
   MODIFY `id` int(10) UNSIGNED NOT NULL AUTO_INCREMENT;
 --
+-- AUTO_INCREMENT für Tabelle `events`
+--
+ALTER TABLE `events`
+  MODIFY `id` bigint(10) UNSIGNED NOT NULL AUTO_INCREMENT;
+--
 -- AUTO_INCREMENT für Tabelle `fermentations`
 --
 ALTER TABLE `fermentations`
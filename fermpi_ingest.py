@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+  FermPi Ingest - Fleet Ingestion Service
+
+  This script collects the readings and events of several FermPi
+  controllers and writes them into the central database, so the
+  controllers do not have to insert every single row by themselves.
+
+  The controllers (see fermpi.py --upload) push compressed batches
+  via HTTP:
+
+      POST /ingest
+      Content-Encoding: deflate
+
+      {"controller": "fermpi-1",
+       "session": 1516700000,
+       "seq": 42,
+       "entries": [["log", 3, 1, 21.56, 1516700123, 21.62],
+                   ["log", 3, 0, 21.50, 1516700123],
+                   ["event", 3, 1516700123, "heater on"],
+                   ["purge", 0]]}
+
+  Log entries of sensors carry the raw reading as last value (null,
+  if the reading failed), the filtered temperature is stored as
+  'temperature'.
+
+  Each controller numbers its batches consecutively per session
+  (i.e. per start of the controller). Batches that have already
+  been accepted are acknowledged again but not stored twice, so a
+  controller can safely resend a batch after a lost response. The
+  session is only used as an id, it isn't compared to other sessions,
+  since a controller's clock may be wrong until it has synchronized.
+
+  Malformed batches are answered with '400'. If the store rejects a
+  batch (e.g. invalid data, missing table or column), it is logged
+  and dropped, only connection problems and lock timeouts are retried.
+
+  The accepted batches are queued and bulk-loaded by a single writer
+  thread. When the queue is full, the service answers with '503' and
+  a 'Retry-After' header and the controllers keep their data until
+  the store has caught up.
+
+  For testing without hardware and database, the service can be
+  started with an in-memory store (--memory) and an artificial
+  store delay (--delay) to provoke back-pressure.
+
+  Author : Holger Kupke
+  Date   : 23.01.2018
+
+  Copyright (c) 2018 Holger Kupke. All rights reserved.
+"""
+
+__version__ = '0.9.1'
+
+import sys
+import math
+import zlib
+import json
+import signal
+import logging
+import threading
+from time import sleep
+from optparse import OptionParser
+from collections import OrderedDict
+
+try:
+    import Queue as queue
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    import queue
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+# service parameters
+INGEST_HOST = ''
+INGEST_PORT = 8097
+
+# database parameters
+DB_HOST = 'homenet'
+DB_USER = 'fermpi'
+DB_PWD = 'frosttau97'
+DB_NAME = 'fermpi'
+
+# queue parameters
+QUEUE_SIZE = 100                 # max. number of pending batches
+BATCH_LIMIT = 5000               # max. number of entries per bulk load
+RETRY_AFTER = 10                 # seconds, suggested to the controllers
+SESSIONS = 4                     # remembered sessions per controller
+
+# MySQL errors worth retrying: too many connections, lock wait timeout,
+# deadlock, can't connect, lost connection
+RETRY_ERRORS = (1040, 1205, 1213, 2002, 2003, 2006, 2013)
+
+try:
+    NUMBER = (int, long, float)
+    STRING = basestring
+except NameError:
+    NUMBER = (int, float)
+    STRING = str
+
+# global variables
+server = None
+writer = None
+
+
+def valid_entry(entry):
+    """Checks the shape and the types of a batch entry.
+
+       Args:
+           entry: log, event or purge entry
+
+       Return:
+           True  = entry can be stored
+           False = malformed entry
+    """
+    def ints(values):
+        return all(isinstance(v, NUMBER) and not isinstance(v, bool) and v == int(v)
+                   for v in values)
+
+    def numbers(values):
+        return all(isinstance(v, NUMBER) and not isinstance(v, bool) and
+                   not math.isnan(v) and not math.isinf(v) for v in values)
+
+    if not isinstance(entry, list) or len(entry) == 0:
+        return False
+
+    try:
+        if entry[0] == 'log':
+            # the raw reading is optional and None, if it failed
+            return len(entry) in (5, 6) and ints([entry[1], entry[2], entry[4]]) and \
+                   numbers(entry[3:4] + [v for v in entry[5:] if v is not None])
+        elif entry[0] == 'event':
+            return len(entry) == 4 and ints(entry[1:3]) and \
+                   isinstance(entry[3], STRING) and len(entry[3]) <= 64
+        elif entry[0] == 'purge':
+            return len(entry) == 2 and ints(entry[1:])
+    except (ValueError, OverflowError):
+        # NaN or infinite ids and timestamps
+        pass
+    return False
+
+
+class MemoryStore(object):
+    """Stand-in store, keeping all entries in memory.
+
+       Args:
+           delay (float): seconds to wait for every write, used to
+                          simulate a slow database
+    """
+    def __init__(self, delay=0.0):
+        self._logger = logging.getLogger(__name__)
+        self._delay = delay
+
+        self.logs = []
+        self.events = []
+        self.writes = int(0)
+
+    def transient(self, e):
+        """Checks, if retrying the failed write may succeed."""
+        return False
+
+    def write(self, entries):
+        """Stores the given entries.
+
+           Args:
+               entries (list): log, event and purge entries
+        """
+        if self._delay > 0:
+            sleep(self._delay)
+
+        for entry in entries:
+            if entry[0] == 'log':
+                self.logs.append(tuple(entry[1:]))
+            elif entry[0] == 'event':
+                self.events.append(tuple(entry[1:]))
+            elif entry[0] == 'purge':
+                self.logs = [row for row in self.logs if row[0] != entry[1]]
+        self.writes += 1
+
+        self._logger.info(" Store:      %d log(s), %d event(s), %d write(s)" %
+                          (len(self.logs), len(self.events), self.writes))
+
+
+class MySQLStore(object):
+    """Central FermPi database.
+
+       Consecutive log and event entries are inserted by a single
+       multi-row statement each, all entries of a write share one
+       transaction.
+    """
+    def __init__(self, host, user, pwd, name):
+        # imported here, so the memory store runs without the driver
+        import MySQLdb as mdb
+
+        self._mdb = mdb
+        self._params = (host, user, pwd, name)
+
+    def transient(self, e):
+        """Checks, if retrying the failed write may succeed.
+
+           Only connection problems and lock timeouts are transient,
+           schema errors like an unknown column are reported as
+           OperationalError as well, but are permanent.
+        """
+        return isinstance(e, self._mdb.OperationalError) and \
+               len(e.args) > 0 and e.args[0] in RETRY_ERRORS
+
+    def write(self, entries):
+        """Stores the given entries.
+
+           Args:
+               entries (list): log, event and purge entries
+        """
+        conn = self._mdb.connect(*self._params)
+        try:
+            with conn as cur:
+                i = 0
+                while i < len(entries):
+                    kind = entries[i][0]
+                    j = i
+                    while j < len(entries) and entries[j][0] == kind:
+                        j += 1
+
+                    if kind == 'log':
+                        rows = [(e[1], e[2], "%1.2f" % (e[3]),
+                                 "%1.2f" % (e[5]) if len(e) > 5 and e[5] is not None else None,
+                                 "%d" % (e[4]))
+                                for e in entries[i:j]]
+                        cur.executemany("""INSERT INTO logs (fermentation, sensor, temperature, raw, timestamp)
+                                           VALUES (%s, %s, %s, %s, %s)""", rows)
+                    elif kind == 'event':
+                        rows = [(e[1], "%d" % (e[2]), e[3]) for e in entries[i:j]]
+                        cur.executemany("""INSERT INTO events (fermentation, timestamp, event)
+                                           VALUES (%s, %s, %s)""", rows)
+                    elif kind == 'purge':
+                        for e in entries[i:j]:
+                            cur.execute("DELETE FROM logs WHERE fermentation = %s", (e[1],))
+                    i = j
+        finally:
+            conn.close()
+
+
+class IngestWriter(threading.Thread):
+    """Writes the accepted batches into the store.
+
+       Queued batches are merged into bulk loads of up to BATCH_LIMIT
+       entries. A bulk load failing for a transient reason (e.g. the
+       database is unreachable) is retried until it succeeds, in the
+       meantime the queue fills up and new batches are rejected. If it
+       fails permanently, the batches are stored one by one and the
+       failing ones are dropped.
+    """
+    def __init__(self, store, size=QUEUE_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self._logger = logging.getLogger(__name__)
+        self._store = store
+
+        self.queue = queue.Queue(size)
+        self.event = threading.Event()
+
+    def _write(self, entries):
+        """Writes the given entries, retries on transient errors.
+
+           Return:
+               True  = entries stored
+               False = entries rejected permanently
+        """
+        while True:
+            try:
+                self._store.write(entries)
+                return True
+            except Exception as e:
+                if not self._store.transient(e):
+                    self._logger.error(" Store error: %s" % (e))
+                    return False
+                self._logger.error(" Store error: %s, retrying..." % (e))
+                sleep(RETRY_AFTER)
+
+    def run(self):
+        while not self.event.is_set() or not self.queue.empty():
+            try:
+                batches = [self.queue.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+
+            # merge pending batches
+            n = len(batches[0])
+            while n < BATCH_LIMIT:
+                try:
+                    batches.append(self.queue.get_nowait())
+                    n += len(batches[-1])
+                except queue.Empty:
+                    break
+
+            if self._write([entry for batch in batches for entry in batch]):
+                continue
+
+            if len(batches) > 1:
+                for batch in batches:
+                    if not self._write(batch):
+                        self._logger.error(" Batch of %d entries dropped" % (len(batch)))
+            else:
+                self._logger.error(" Batch of %d entries dropped" % (n))
+
+
+class IngestServer(ThreadingMixIn, HTTPServer):
+    """HTTP server, keeping track of the controllers' sequence numbers."""
+    daemon_threads = True
+
+    def __init__(self, address, writer):
+        HTTPServer.__init__(self, address, IngestHandler)
+
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.sequences = {}      # controller -> {session: last seq}
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    """Handles the batch uploads of the controllers."""
+
+    def _reply(self, code, status, retry=None):
+        body = json.dumps({'status': status}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if retry is not None:
+            self.send_header('Retry-After', str(retry))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/ingest':
+            self._reply(404, 'unknown path')
+            return
+
+        try:
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Encoding') == 'deflate':
+                data = zlib.decompress(data)
+            batch = json.loads(data.decode('utf-8'))
+
+            controller = str(batch['controller'])
+            session = int(batch['session'])
+            seq = int(batch['seq'])
+            entries = batch['entries']
+            if not isinstance(entries, list) or not all(valid_entry(e) for e in entries):
+                raise ValueError('invalid entries')
+        except (ValueError, KeyError, TypeError, AttributeError, zlib.error):
+            self._reply(400, 'invalid batch')
+            return
+
+        srv = self.server
+        with srv.lock:
+            sessions = srv.sequences.setdefault(controller, OrderedDict())
+            if seq <= sessions.get(session, 0):
+                self._reply(200, 'duplicate')
+                return
+
+            try:
+                srv.writer.queue.put_nowait(entries)
+            except queue.Full:
+                self._reply(503, 'busy', RETRY_AFTER)
+                return
+
+            # the latest session last
+            sessions.pop(session, None)
+            sessions[session] = seq
+            while len(sessions) > SESSIONS:
+                sessions.popitem(last=False)
+
+        self._reply(200, 'ok')
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(" %s - %s" %
+                                          (self.address_string(), format % args))
+
+
+def on_exit(sig, frame):
+    """Clean up on exit"""
+    logger = logging.getLogger(__name__)
+    logger.info(" Cleaning up...")
+
+    # shutdown() blocks until serve_forever() has returned
+    threading.Thread(target=server.shutdown).start()
+
+def main():
+    global server, writer
+
+    # register exit handler
+    signal.signal(signal.SIGINT, on_exit)
+    signal.signal(signal.SIGTERM, on_exit)
+
+    # check commandline parameters
+    parser = OptionParser()
+    parser.add_option("-d", "--debug", dest="debug", action="store_true", default=False, help="print debug information to stdout")
+    parser.add_option("-p", "--port", dest="port", type="int", default=INGEST_PORT, help="port to listen on")
+    parser.add_option("-m", "--memory", dest="memory", action="store_true", default=False, help="use an in-memory store instead of the database")
+    parser.add_option("--delay", dest="delay", type="float", default=0.0, help="delay of the in-memory store in seconds")
+    parser.add_option("--queue", dest="queue", type="int", default=QUEUE_SIZE, help="max. number of pending batches")
+    (options, args) = parser.parse_args(sys.argv)
+
+    if options.debug is True:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    logger = logging.getLogger(__name__)
+    logger.info(" FermPi Ingest - Fleet Ingestion Service")
+    logger.info(" Copyright (c) 2018 Holger Kupke")
+
+    if options.memory is True:
+        store = MemoryStore(options.delay)
+    else:
+        store = MySQLStore(DB_HOST, DB_USER, DB_PWD, DB_NAME)
+
+    writer = IngestWriter(store, options.queue)
+    writer.start()
+
+    server = IngestServer((INGEST_HOST, options.port), writer)
+    logger.info(" Listening on port %d..." % (options.port))
+    server.serve_forever()
+    server.server_close()
+
+    # store pending batches
+    logger.info(" Flushing queue...")
+    writer.event.set()
+    writer.join()
+
+    logger.info(" Bye.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+-- FermPi - Upgrade of an existing database
+--
+-- Brings a database created by an older fermpi.sql up to date.
+-- Run the sections of the versions you are upgrading from.
+
+USE `fermpi`;
+
+-- --------------------------------------------------------
+
+--
+-- Fleet ingestion service (fermpi_ingest.py)
+--
+
+CREATE TABLE IF NOT EXISTS `events` (
+  `id` bigint(10) UNSIGNED NOT NULL AUTO_INCREMENT,
+  `fermentation` int(10) UNSIGNED NOT NULL,
+  `timestamp` varchar(24) NOT NULL,
+  `event` varchar(64) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `EVT` (`fermentation`,`timestamp`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- --------------------------------------------------------
+
+--
+-- Raw sensor readings (signal conditioning)
+--
+
+ALTER TABLE `logs`
+  ADD COLUMN `raw` varchar(7) DEFAULT NULL AFTER `temperature`;